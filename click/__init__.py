@@ -1,3 +1,3 @@
-from .core import echo, command
+from .core import echo, echo_many, command
 
-__all__ = ["echo", "command"]
\ No newline at end of file
+__all__ = ["echo", "echo_many", "command"]
\ No newline at end of file
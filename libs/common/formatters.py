@@ -1,9 +1,12 @@
 """Formatting helpers shared across Bazel targets."""
 
+from functools import lru_cache
+
 from colorama import color_text
 from colorama.ansi import green
 
 
+@lru_cache(maxsize=1024)
 def format_greeting(message: str) -> str:
     """Wrap the message in a predictable color sequence."""
     return color_text(green(message), "yellow")
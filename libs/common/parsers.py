@@ -1,6 +1,9 @@
 """Parsing helpers shared across Bazel targets."""
 
+from functools import lru_cache
 
+
+@lru_cache(maxsize=1024)
 def normalize_name(raw: str) -> str:
     """Normalize a raw identifier into title-case."""
-    return " ".join(part.title() for part in raw.strip().split())
+    return " ".join(raw.split()).title()
@@ -1,12 +1,16 @@
 """Analyzer helpers built on top of the reporting service."""
 
-from typing import Iterable
+from typing import Iterable, List
 
 from services.reporting import average_score, build_report
 
 
 def summarize(subjects: Iterable[str]) -> str:
     """Build a compact summary for the provided subjects."""
-    reports = [build_report(subject) for subject in subjects]
-    score = average_score(len(subject) for subject in subjects)
+    reports: List[str] = []
+    lengths: List[int] = []
+    for subject in subjects:
+        reports.append(build_report(subject))
+        lengths.append(len(subject))
+    score = average_score(lengths)
     return f"Summary[{score:.1f}] -> {' | '.join(reports)}"
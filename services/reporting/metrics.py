@@ -6,7 +6,11 @@ from typing import Iterable
 
 def average_score(values: Iterable[float]) -> float:
     """Return an average score, guarding against division by zero."""
-    values = list(values)
-    if not values:
+    total = 0.0
+    count = 0
+    for value in values:
+        total += value
+        count += 1
+    if not count:
         return 0.0
-    return sum(values) / len(values)
+    return total / count
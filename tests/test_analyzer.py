@@ -0,0 +1,12 @@
+"""Tests for plugins.analyzer."""
+
+from __future__ import annotations
+
+from plugins.analyzer import summarize
+
+
+def test_summarize_accepts_a_one_shot_iterator() -> None:
+    subjects = ["ab", "abcd"]
+    summary = summarize(subject for subject in subjects)
+    assert summary == summarize(subjects)
+    assert summary.startswith("Summary[3.0] -> ")
@@ -0,0 +1,29 @@
+"""Tests for click.core."""
+
+from __future__ import annotations
+
+import pytest
+
+from click import echo, echo_many
+from colorama import color_text
+
+
+def test_echo_writes_one_colored_line(capsys: pytest.CaptureFixture[str]) -> None:
+    echo("hello")
+    assert capsys.readouterr().out == color_text("hello", "blue") + "\n"
+
+
+def test_echo_many_writes_one_colored_line_per_message(capsys: pytest.CaptureFixture[str]) -> None:
+    msgs = ["first", "second", "third"]
+    echo_many(iter(msgs))
+    out = capsys.readouterr().out
+    assert out == "".join(color_text(msg, "blue") + "\n" for msg in msgs)
+
+    for msg in msgs:
+        echo(msg)
+    assert capsys.readouterr().out == out
+
+
+def test_echo_many_with_no_messages_writes_nothing(capsys: pytest.CaptureFixture[str]) -> None:
+    echo_many([])
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,23 @@
+"""Tests for libs.common.parsers."""
+
+from __future__ import annotations
+
+import pytest
+
+from libs.common.parsers import normalize_name
+
+
+@pytest.mark.parametrize(
+    ("raw", "expected"),
+    [
+        ("my_project", "My_Project"),
+        ("  daily   report\t", "Daily Report"),
+        ("cli-report", "Cli-Report"),
+        ("o'neil MCDONALD", "O'Neil Mcdonald"),
+        ("", ""),
+        ("   ", ""),
+    ],
+)
+def test_normalize_name_title_cases_and_collapses_whitespace(raw: str, expected: str) -> None:
+    assert normalize_name(raw) == expected
+    assert normalize_name(raw) == " ".join(part.title() for part in raw.strip().split())
@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 
+import contextlib
+import io
 import json
 import os
 import subprocess
@@ -9,11 +11,18 @@ import sys
 import tempfile
 import time
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, Iterator, List
 
 import pytest
 
-from tools.pyrefly_bazel_query import system_python_platform
+from tools import pyrefly_bazel_query
+from tools.pyrefly_bazel_query import (
+    QUERY_FILE_THRESHOLD,
+    bazel_query,
+    parse_buildozer_output,
+    py_targets_query,
+    system_python_platform,
+)
 
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
@@ -34,6 +43,8 @@ def _prepare_env(
     env["PATH"] = f"{STUB_DIR}:{env.get('PATH', '')}"
     env["BAZEL_STUB_WORKSPACE"] = str(REPO_ROOT)
     env["BAZEL_STUB_FIXTURES"] = str(fixture_path)
+    env["PYREFLY_BAZEL_CACHE"] = "0"
+    env["PYREFLY_WARMUP"] = "0"
     if log_path is not None:
         env["BAZEL_STUB_LOG"] = str(log_path)
     if extra_env:
@@ -76,6 +87,47 @@ def _run_tool(
             pass
 
 
+def _call_tool(
+    files: Iterable[str],
+    monkeypatch: pytest.MonkeyPatch,
+    *,
+    fixture_path: Path = BASE_FIXTURE,
+    extra_env: Dict[str, str] | None = None,
+    log_path: Path | None = None,
+    pretty: bool = False,
+) -> str:
+    """Run the tool in-process against the Bazel stub and return its stdout."""
+    for name, value in _prepare_env(fixture_path, extra_env=extra_env, log_path=log_path).items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.chdir(REPO_ROOT)
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf):
+        assert pyrefly_bazel_query.main_with_files(list(files), pretty=pretty) == 0
+    return buf.getvalue()
+
+
+def _logged_calls(log_path: Path) -> Iterator[List[str]]:
+    """Yield the argv of each stubbed Bazel call, decoding the log one line at a time."""
+    if not log_path.exists():
+        return
+    with log_path.open("r", encoding="utf-8") as fh:
+        for line in fh:
+            yield json.loads(line)
+
+
+def _query_args(files: Iterable[str]) -> List[str]:
+    """Argv of the single query the tool issues for `files`."""
+    return [
+        "query",
+        py_targets_query(list(files)),
+        "--keep_going",
+        "--noshow_progress",
+        "--noimplicit_deps",
+        "--output",
+        "streamed_jsonproto",
+    ]
+
+
 def _load_snapshot(snapshot_path: Path) -> Dict[str, object]:
     raw = snapshot_path.read_text(encoding="utf-8")
     replacements = {
@@ -109,6 +161,7 @@ def _assert_distribution_entry(entry: Dict[str, object]) -> None:
 
 
 def test_single_file_query_matches_expected_snapshot() -> None:
+    # End-to-end smoke test through the real CLI entry point; other tests run in-process
     result = _run_tool(["my_project/main.py"])
     assert result.returncode == 0, result.stderr
     actual = json.loads(result.stdout)
@@ -116,10 +169,8 @@ def test_single_file_query_matches_expected_snapshot() -> None:
     assert actual == expected
 
 
-def test_json_schema_validation() -> None:
-    result = _run_tool(["my_project/main.py"])
-    assert result.returncode == 0, result.stderr
-    payload = json.loads(result.stdout)
+def test_json_schema_validation(monkeypatch: pytest.MonkeyPatch) -> None:
+    payload = json.loads(_call_tool(["my_project/main.py"], monkeypatch))
     assert set(payload.keys()) == {"db", "root"}
     assert payload["root"] == str(REPO_ROOT)
     db = payload["db"]
@@ -130,7 +181,7 @@ def test_json_schema_validation() -> None:
         _assert_distribution_entry(entry)
 
 
-def test_multi_file_query_includes_full_project_snapshot() -> None:
+def test_multi_file_query_includes_full_project_snapshot(monkeypatch: pytest.MonkeyPatch) -> None:
     files = [
         "my_project/main.py",
         "libs/common/formatters.py",
@@ -138,17 +189,13 @@ def test_multi_file_query_includes_full_project_snapshot() -> None:
         "scripts/run_report.py",
         "services/reporting/report_cli.py",
     ]
-    result = _run_tool(files)
-    assert result.returncode == 0, result.stderr
-    actual = json.loads(result.stdout)
+    actual = json.loads(_call_tool(files, monkeypatch))
     expected = _load_snapshot(REPO_ROOT / "tests/expected_outputs/full_project.json")
     assert actual == expected
 
 
-def test_dependency_resolution_captures_transitive_and_self_dependencies() -> None:
-    result = _run_tool(["services/reporting/report_cli.py"])
-    assert result.returncode == 0, result.stderr
-    payload = json.loads(result.stdout)
+def test_dependency_resolution_captures_transitive_and_self_dependencies(monkeypatch: pytest.MonkeyPatch) -> None:
+    payload = json.loads(_call_tool(["services/reporting/report_cli.py"], monkeypatch))
     db = payload["db"]
     assert set(db["//services/reporting:report_cli"]["deps"]) == {
         "//click:click_lib",
@@ -161,14 +208,12 @@ def test_dependency_resolution_captures_transitive_and_self_dependencies() -> No
     assert set(db["//click:click_lib"]["deps"]) == {"//colorama:colorama_lib"}
 
 
-def test_module_path_resolution_for_libraries_binaries_and_packages() -> None:
-    result = _run_tool([
+def test_module_path_resolution_for_libraries_binaries_and_packages(monkeypatch: pytest.MonkeyPatch) -> None:
+    db = json.loads(_call_tool([
         "scripts/run_report.py",
         "click/core.py",
         "plugins/analyzer.py",
-    ])
-    assert result.returncode == 0, result.stderr
-    db = json.loads(result.stdout)["db"]
+    ], monkeypatch))["db"]
 
     # py_binary short module name
     assert "run_report" in db["//scripts:run_report"]["srcs"]
@@ -183,52 +228,286 @@ def test_module_path_resolution_for_libraries_binaries_and_packages() -> None:
     assert "plugins.analyzer" in db["//plugins:analyzer"]["srcs"]
 
 
-def test_invalid_file_path_returns_empty_database() -> None:
-    result = _run_tool(["nonexistent/file.py"])
-    assert result.returncode == 0, result.stderr
-    payload = json.loads(result.stdout)
+def test_absolute_file_paths_resolve_like_relative_ones(monkeypatch: pytest.MonkeyPatch) -> None:
+    relative = json.loads(_call_tool(["my_project/main.py"], monkeypatch))
+    absolute = json.loads(_call_tool([str(REPO_ROOT / "my_project" / "main.py"), "/elsewhere/x.py"], monkeypatch))
+    assert absolute == relative
+    # Relative paths that climb out of the workspace are dropped as well
+    escaping = json.loads(_call_tool(["my_project/main.py", "../x.py", "my_project/../../y.py"], monkeypatch))
+    assert escaping == relative
+
+
+def test_unquotable_file_paths_are_skipped(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    expected = json.loads(_call_tool(["my_project/main.py"], monkeypatch))
+    log_path = tmp_path / "bazel_log.txt"
+    actual = json.loads(_call_tool(['my_project/main".py', "my_project/main.py"], monkeypatch, log_path=log_path))
+    assert actual == expected
+    assert [args for args in _logged_calls(log_path) if args[:1] == ["query"]] == [_query_args(["my_project/main.py"])]
+
+
+def test_root_package_sources_resolve_to_their_owner(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    rule = {
+        "type": "RULE",
+        "rule": {
+            "name": "//:tool",
+            "ruleClass": "py_binary",
+            "attribute": [
+                {"name": "srcs", "type": "LABEL_LIST", "stringListValue": ["//:setup.py"]},
+                {"name": "deps", "type": "LABEL_LIST", "stringListValue": ["//click:click_lib"]},
+            ],
+        },
+    }
+    fixture = json.loads(BASE_FIXTURE.read_text(encoding="utf-8"))
+    click_rules = fixture["commands"][json.dumps(_query_args(["click/core.py"]))]["stdout"]
+    root_fixture = tmp_path / "bazel_root_package.json"
+    root_fixture.write_text(json.dumps({"commands": {
+        json.dumps(_query_args(["setup.py"])): {
+            "stdout": json.dumps(rule) + "\n" + click_rules,
+            "stderr": "",
+            "returncode": 0,
+        },
+    }}), encoding="utf-8")
+
+    db = json.loads(_call_tool(["setup.py"], monkeypatch, fixture_path=root_fixture))["db"]
+    assert db["//:tool"]["srcs"] == {"setup": ["setup.py"]}
+    assert db["//:tool"]["deps"] == ["//click:click_lib"]
+    assert pyrefly_bazel_query.module_name_from_path(pyrefly_bazel_query.file_label_to_path("//:pkg/__init__.py")) == "pkg"
+
+
+def test_invalid_file_path_returns_empty_database(monkeypatch: pytest.MonkeyPatch) -> None:
+    payload = json.loads(_call_tool(["nonexistent/file.py"], monkeypatch))
     assert payload["db"] == {}
     assert payload["root"] == str(REPO_ROOT)
 
 
-def test_no_arguments_returns_error_json() -> None:
-    cmd = [sys.executable, str(REPO_ROOT / "tools" / "pyrefly_bazel_query.py")]
-    env = _prepare_env(BASE_FIXTURE)
-    result = subprocess.run(
-        cmd,
-        cwd=REPO_ROOT,
-        env=env,
-        text=True,
-        capture_output=True,
-        check=False,
-    )
-    assert result.returncode == 2
-    assert json.loads(result.stdout) == {"error": "Usage: script.py @/path/to/list.txt"}
+def test_output_is_compact_unless_pretty_requested(monkeypatch: pytest.MonkeyPatch) -> None:
+    compact = _call_tool(["my_project/main.py"], monkeypatch)
+    pretty = _call_tool(["my_project/main.py"], monkeypatch, pretty=True)
+    assert compact.count("\n") == 1
+    assert compact == json.dumps(json.loads(compact), separators=(",", ":"), ensure_ascii=False) + "\n"
+    assert pretty == json.dumps(json.loads(compact), indent=2, ensure_ascii=False) + "\n"
+
+    # Non-ASCII paths are written unescaped, whichever encoder is in use
+    out: pyrefly_bazel_query.BuildDbResult = {
+        "db": {
+            "//caf\u00e9:lib": {
+                "srcs": {"caf\u00e9": ["caf\u00e9/__init__.py"]},
+                "deps": [],
+                "python_version": "3.12",
+                "python_platform": "linux",
+                "buildfile_path": "//caf\u00e9/BUILD.bazel",
+            },
+        },
+        "root": "/ws/\u00e9",
+    }
+    buf = io.StringIO()
+    pyrefly_bazel_query.write_result(out, buf)
+    assert buf.getvalue() == json.dumps(out, separators=(",", ":"), ensure_ascii=False) + "\n"
+    assert "\u00e9" in buf.getvalue()
+    buf = io.StringIO()
+    pyrefly_bazel_query.write_result(out, buf, pretty=True)
+    assert buf.getvalue() == json.dumps(out, indent=2, ensure_ascii=False) + "\n"
 
 
-def test_command_handles_bazel_warnings(tmp_path: Path) -> None:
+def test_no_arguments_returns_error_json(capsys: pytest.CaptureFixture[str]) -> None:
+    assert pyrefly_bazel_query.main([]) == 2
+    assert json.loads(capsys.readouterr().out) == {"error": "Usage: script.py @/path/to/list.txt"}
+
+
+def test_command_handles_bazel_warnings(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
     fixture = json.loads(BASE_FIXTURE.read_text(encoding="utf-8"))
-    key = json.dumps([
-        "query",
-        "labels('deps', //click:click_lib)",
-        "--keep_going",
-        "--noshow_progress",
-    ])
-    entry = fixture["commands"][key]
+    entry = fixture["commands"][json.dumps(_query_args(["click/core.py"]))]
     entry["stderr"] = "WARNING: some Bazel warning about embedded tools\n"
     entry["returncode"] = 3
     warning_fixture = tmp_path / "bazel_warning.json"
     warning_fixture.write_text(json.dumps(fixture, indent=2), encoding="utf-8")
 
-    result = _run_tool(["click/core.py"], fixture_path=warning_fixture)
-    assert result.returncode == 0, result.stderr
-    payload = json.loads(result.stdout)
+    payload = json.loads(_call_tool(["click/core.py"], monkeypatch, fixture_path=warning_fixture))
     assert "//click:click_lib" in payload["db"]
 
 
-def test_python_version_and_platform_detection_consistent_with_runtime() -> None:
-    result = _run_tool(["my_project/main.py"])
-    payload = json.loads(result.stdout)
+def test_query_cache_skips_bazel_on_repeat_runs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    log_path = tmp_path / "bazel_log.txt"
+    cache_env = {"PYREFLY_BAZEL_CACHE": "1", "XDG_CACHE_HOME": str(tmp_path / "cache"), "PYREFLY_WARMUP": "1"}
+
+    first = _call_tool(["my_project/main.py"], monkeypatch, extra_env=cache_env, log_path=log_path)
+    assert ["version"] in list(_logged_calls(log_path)), "a cache miss should warm the server"
+    log_path.unlink()
+
+    second = _call_tool(["my_project/main.py"], monkeypatch, extra_env=cache_env, log_path=log_path)
+    assert json.loads(second) == json.loads(first)
+    calls = [args for args in _logged_calls(log_path) if args != ["--version"]]
+    assert not calls, "warm run should be served from the cache without starting the server"
+
+
+def test_partial_query_results_are_not_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    fixture = json.loads(BASE_FIXTURE.read_text(encoding="utf-8"))
+    entry = fixture["commands"][json.dumps(_query_args(["my_project/main.py"]))]
+    entry["stdout"] = entry["stdout"].splitlines(keepends=True)[0]
+    entry["returncode"] = 3
+    partial_fixture = tmp_path / "bazel_partial.json"
+    partial_fixture.write_text(json.dumps(fixture, indent=2), encoding="utf-8")
+    log_path = tmp_path / "bazel_log.txt"
+    cache_env = {"PYREFLY_BAZEL_CACHE": "1", "XDG_CACHE_HOME": str(tmp_path / "cache")}
+
+    for _ in range(2):
+        _call_tool(["my_project/main.py"], monkeypatch, fixture_path=partial_fixture, extra_env=cache_env, log_path=log_path)
+    queries = [args for args in _logged_calls(log_path) if args[:1] == ["query"]]
+    assert len(queries) == 2, "a query that exited non-zero must be re-run, not replayed from the cache"
+
+
+def test_cache_entry_is_replaced_when_the_fingerprint_changes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    key = json.dumps([["bazel", "query", "//..."], "/ws"])
+    pyrefly_bazel_query.cache_put(key, "old", "a")
+    pyrefly_bazel_query.cache_put(key, "new", "b")
+
+    assert pyrefly_bazel_query.cache_get(key, "old") is None
+    assert pyrefly_bazel_query.cache_get(key, "new") == "b"
+    assert len(list(tmp_path.rglob("*.json"))) == 1, "stale entries should be overwritten, not orphaned"
+
+
+def test_cache_fingerprint_tracks_module_and_bzl_files(tmp_path: Path) -> None:
+    (tmp_path / "MODULE.bazel").write_text("module(name = 'ws')\n", encoding="utf-8")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "BUILD.bazel").write_text("", encoding="utf-8")
+    (tmp_path / "pkg" / "defs.bzl").write_text("", encoding="utf-8")
+    (tmp_path / "pkg" / "lib.py").write_text("", encoding="utf-8")
+
+    before = pyrefly_bazel_query.buildfile_mtimes(str(tmp_path))
+    assert [path for path, _ in before] == [
+        ".", "MODULE.bazel", "pkg", os.path.join("pkg", "BUILD.bazel"), os.path.join("pkg", "defs.bzl"),
+    ]
+    os.utime(tmp_path / "MODULE.bazel", ns=(0, 0))
+    assert pyrefly_bazel_query.buildfile_mtimes(str(tmp_path)) != before
+
+
+def test_workspace_fingerprint_is_recomputed_in_process(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PATH", f"{STUB_DIR}:{os.environ.get('PATH', '')}")
+    (tmp_path / "MODULE.bazel").write_text("", encoding="utf-8")
+    before = pyrefly_bazel_query.workspace_fingerprint(str(tmp_path))
+    (tmp_path / "BUILD.bazel").write_text("", encoding="utf-8")
+    assert pyrefly_bazel_query.workspace_fingerprint(str(tmp_path)) != before
+
+
+def test_output_base_is_passed_as_startup_option(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    log_path = tmp_path / "bazel_log.txt"
+    output_base = tmp_path / "output_base"
+    _call_tool(
+        ["my_project/main.py"],
+        monkeypatch,
+        extra_env={"PYREFLY_BAZEL_OUTPUT_BASE": str(output_base)},
+        log_path=log_path,
+    )
+    (args,) = _logged_calls(log_path)
+    assert args[:2] == [f"--output_base={output_base}", "query"]
+
+
+def test_buildfile_path_comes_from_rule_location(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    fixture = json.loads(BASE_FIXTURE.read_text(encoding="utf-8"))
+    entry = fixture["commands"][json.dumps(_query_args(["click/core.py"]))]
+    # Point at a file that does not exist on disk: the path must come from bazel, not a filesystem probe
+    entry["stdout"] = entry["stdout"].replace("/click/BUILD.bazel:", "/click/BUILD:")
+    location_fixture = tmp_path / "bazel_location.json"
+    location_fixture.write_text(json.dumps(fixture, indent=2), encoding="utf-8")
+
+    db = json.loads(_call_tool(["click/core.py"], monkeypatch, fixture_path=location_fixture))["db"]
+    assert db["//click:click_lib"]["buildfile_path"] == "//click/BUILD"
+    assert db["//colorama:colorama_lib"]["buildfile_path"] == "//colorama/BUILD.bazel"
+
+
+def test_long_query_expressions_use_query_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    labels = [f"//pkg{i}:lib{i}" for i in range(QUERY_FILE_THRESHOLD // 10)]
+    expr = f"set({' '.join(labels)})"
+    assert len(expr) > QUERY_FILE_THRESHOLD
+    fixture = tmp_path / "bazel_query_file.json"
+    fixture.write_text(json.dumps({"commands": {
+        json.dumps(["query", expr, "--keep_going", "--noshow_progress", "--noimplicit_deps"]): {
+            "stdout": "\n".join(labels) + "\n",
+            "stderr": "",
+            "returncode": 0,
+        },
+    }}), encoding="utf-8")
+    log_path = tmp_path / "bazel_log.txt"
+    for name, value in _prepare_env(fixture, log_path=log_path).items():
+        monkeypatch.setenv(name, value)
+
+    assert bazel_query(expr) == labels
+    (args,) = _logged_calls(log_path)
+    assert args[1].startswith("--query_file=")
+    assert expr not in args
+
+
+def test_run_stream_yields_lines_and_reports_failures() -> None:
+    script = "import sys; print('a'); print(); print(' b '); sys.exit(3)"
+    stream = pyrefly_bazel_query.run_stream([sys.executable, "-c", script])
+    assert [next(stream), next(stream)] == ["a", "b"]
+    with pytest.raises(StopIteration) as done:
+        next(stream)
+    assert done.value.value == 3, "the exit code is the generator's return value"
+    with pytest.raises(RuntimeError, match="boom"):
+        list(pyrefly_bazel_query.run_stream([sys.executable, "-c", "import sys; sys.exit('boom')"]))
+
+
+def test_buildozer_output_resolves_relative_labels() -> None:
+    out = "\n".join([
+        "//services/reporting:report_cli py_binary [report_cli.py] [:reporting_lib //click:click_lib]",
+        "//colorama:colorama_lib py_library [__init__.py ansi.py] (missing)",
+        "//libs/common:common_utils py_library glob([\"*.py\"], exclude = [\"x.py\"]) [//colorama]",
+    ])
+    assert parse_buildozer_output(out) == {
+        "//services/reporting:report_cli": {
+            "kind": "py_binary",
+            "srcs": ["//services/reporting:report_cli.py"],
+            "deps": ["//services/reporting:reporting_lib", "//click:click_lib"],
+            "buildfile": "",
+        },
+        "//colorama:colorama_lib": {
+            "kind": "py_library",
+            "srcs": ["//colorama:__init__.py", "//colorama:ansi.py"],
+            "deps": [],
+            "buildfile": "",
+        },
+        "//libs/common:common_utils": {
+            "kind": "py_library",
+            "srcs": [],
+            "deps": ["//colorama:colorama"],
+            "buildfile": "",
+        },
+    }
+
+
+def test_external_python_deps_are_resolved_in_the_same_query(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    fixture = json.loads(BASE_FIXTURE.read_text(encoding="utf-8"))
+    entry = fixture["commands"][json.dumps(_query_args(["click/core.py"]))]
+    rules = [json.loads(line) for line in entry["stdout"].splitlines()]
+    for target in rules:
+        if target["rule"]["name"] == "//click:click_lib":
+            for attr in target["rule"]["attribute"]:
+                if attr["name"] == "deps":
+                    attr["stringListValue"] = ["//colorama:colorama_lib", "@pypi//rich:pkg", "@pypi//:data"]
+    # deps() follows edges into external repositories, so their python rules come back alongside
+    rules.append({
+        "type": "RULE",
+        "rule": {
+            "name": "@pypi//rich:pkg",
+            "ruleClass": "py_library",
+            "attribute": [{"name": "srcs", "type": "LABEL_LIST", "stringListValue": ["@pypi//rich:__init__.py"]}],
+        },
+    })
+    entry["stdout"] = "".join(json.dumps(target) + "\n" for target in rules)
+    external_fixture = tmp_path / "bazel_external.json"
+    external_fixture.write_text(json.dumps(fixture, indent=2), encoding="utf-8")
+    log_path = tmp_path / "bazel_log.txt"
+
+    db = json.loads(_call_tool(["click/core.py"], monkeypatch, fixture_path=external_fixture, log_path=log_path))["db"]
+    assert db["//click:click_lib"]["deps"] == ["//colorama:colorama_lib", "@pypi//rich:pkg"]
+    assert list(db["@pypi//rich:pkg"]["srcs"].values()) == [["@pypi//rich:__init__.py"]]
+    assert len(list(_logged_calls(log_path))) == 1
+
+
+def test_python_version_and_platform_detection_consistent_with_runtime(monkeypatch: pytest.MonkeyPatch) -> None:
+    payload = json.loads(_call_tool(["my_project/main.py"], monkeypatch))
     version = f"{sys.version_info.major}.{sys.version_info.minor}"
     platform = system_python_platform()
     for entry in payload["db"].values():
@@ -236,84 +515,76 @@ def test_python_version_and_platform_detection_consistent_with_runtime() -> None
         assert entry["python_platform"] == platform
 
 
-def test_regression_snapshot_matches_expected_full_project() -> None:
-    result = _run_tool([
+def test_regression_snapshot_matches_expected_full_project(monkeypatch: pytest.MonkeyPatch) -> None:
+    actual = json.loads(_call_tool([
         "my_project/main.py",
         "plugins/analyzer.py",
         "scripts/run_report.py",
         "services/reporting/report_cli.py",
-    ])
-    assert result.returncode == 0, result.stderr
-    actual = json.loads(result.stdout)
+    ], monkeypatch))
     expected = _load_snapshot(REPO_ROOT / "tests/expected_outputs/full_project.json")
     assert actual == expected
 
 
-def test_large_project_performance(tmp_path: Path) -> None:
-    size = 25
+def _write_chain_fixture(tmp_path: Path, size: int) -> Path:
+    """Fixture where //pkg{i}:lib{i} depends on //pkg{i+1}:lib{i+1}."""
     commands: Dict[str, Dict[str, object]] = {}
 
     def k(args: List[str]) -> str:
         return json.dumps(args)
 
     all_targets: List[str] = [f"//pkg{i}:lib{i}" for i in range(size)]
-    commands[k([
-        "query",
-        "kind('py_.* rule', //...)",
-        "--keep_going",
-        "--noshow_progress",
-    ])] = {"stdout": "\n".join(all_targets) + "\n", "stderr": "", "returncode": 0}
-
+    rule_lines: List[str] = []
     for idx, label in enumerate(all_targets):
-        src = f"//pkg{idx}:module{idx}.py"
-        commands[k([
-            "query",
-            f"labels('srcs', {label})",
-            "--keep_going",
-            "--noshow_progress",
-        ])] = {"stdout": f"{src}\n", "stderr": "", "returncode": 0}
-        dep_label = all_targets[idx + 1] if idx + 1 < size else ""
-        dep_stdout = f"{dep_label}\n" if dep_label else ""
-        commands[k([
-            "query",
-            f"labels('deps', {label})",
-            "--keep_going",
-            "--noshow_progress",
-        ])] = {"stdout": dep_stdout, "stderr": "", "returncode": 0}
-        commands[k([
-            "query",
-            label,
-            "--keep_going",
-            "--noshow_progress",
-            "--output",
-            "label_kind",
-        ])] = {"stdout": f"py_library rule {label}\n", "stderr": "", "returncode": 0}
-
-    large_fixture = tmp_path / "bazel_large_project.json"
-    large_fixture.write_text(json.dumps({"commands": commands}, indent=2), encoding="utf-8")
+        dep_labels = [all_targets[idx + 1]] if idx + 1 < size else []
+        rule_lines.append(json.dumps({
+            "type": "RULE",
+            "rule": {
+                "name": label,
+                "ruleClass": "py_library",
+                "attribute": [
+                    {"name": "srcs", "type": "LABEL_LIST", "stringListValue": [f"//pkg{idx}:module{idx}.py"]},
+                    {"name": "deps", "type": "LABEL_LIST", "stringListValue": dep_labels},
+                ],
+            },
+        }))
+    commands[k(_query_args(["pkg0/module0.py"]))] = {"stdout": "\n".join(rule_lines) + "\n", "stderr": "", "returncode": 0}
+
+    fixture = tmp_path / f"bazel_chain_{size}.json"
+    fixture.write_text(json.dumps({"commands": commands}, indent=2), encoding="utf-8")
+    return fixture
+
+
+def test_large_project_performance(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    size = 25
+    large_fixture = _write_chain_fixture(tmp_path, size)
 
     start = time.perf_counter()
-    result = _run_tool(["pkg0/module0.py"], fixture_path=large_fixture)
+    stdout = _call_tool(["pkg0/module0.py"], monkeypatch, fixture_path=large_fixture)
     duration = time.perf_counter() - start
 
-    assert result.returncode == 0, result.stderr
     assert duration < 6, f"Query should finish quickly, took {duration:.2f}s"
-    payload = json.loads(result.stdout)
+    payload = json.loads(stdout)
     assert len(payload["db"]) == size
 
 
-def test_query_efficiency_minimises_redundant_label_kind_calls(tmp_path: Path) -> None:
+def test_deep_dependency_chain_exceeds_recursion_limit(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    size = sys.getrecursionlimit() + 500
+    db = json.loads(_call_tool(["pkg0/module0.py"], monkeypatch, fixture_path=_write_chain_fixture(tmp_path, size)))["db"]
+    # post-order: deepest dependency first, requested target last
+    assert list(db) == [f"//pkg{i}:lib{i}" for i in reversed(range(size))]
+
+
+def test_query_efficiency_issues_single_batched_query(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
     log_path = tmp_path / "bazel_log.txt"
-    result = _run_tool(["my_project/main.py"], log_path=log_path)
-    assert result.returncode == 0, result.stderr
+    _call_tool(["my_project/main.py"], monkeypatch, log_path=log_path)
 
-    label_kind_calls = []
-    for line in log_path.read_text(encoding="utf-8").splitlines():
-        args = json.loads(line)
-        if args[:2] == ["query", "kind('py_.* rule', //...)"]:
-            continue
-        if args[-2:] == ["--output", "label_kind"]:
-            label_kind_calls.append(args[1])
+    query_calls = []
+    for args in _logged_calls(log_path):
+        assert args != ["info", "workspace"], "workspace root should be found without invoking bazel"
+        if args[:1] == ["query"]:
+            query_calls.append(args)
 
-    assert label_kind_calls, "expected at least one label_kind query"
-    assert len(label_kind_calls) == len(set(label_kind_calls)), "label_kind queries should be cached per label"
+    assert query_calls == [_query_args(["my_project/main.py"])], (
+        "owners, srcs, deps and kinds should come from a single batched query"
+    )
@@ -3,7 +3,12 @@
 Bazel-backed source DB query for Pyrefly-style integration.
 
 Usage:
-  python3 tools/pyrefly_bazel_query.py @/path/to/file_list.txt
+  python3 tools/pyrefly_bazel_query.py [--use_buildozer] [--pretty] @/path/to/file_list.txt
+
+  --use_buildozer  read srcs/deps straight from BUILD files with `buildozer print`
+                   instead of `bazel query` (falls back to bazel if buildozer is
+                   not on PATH; globs and macros are not expanded in this mode)
+  --pretty         indent the JSON output (compact by default)
 
 Output JSON shape:
 
@@ -25,35 +30,66 @@ Notes:
 - Keys are ALWAYS unique Bazel labels for the owning targets (no dist heuristics).
 - Deps are emitted as Bazel labels of *python* deps only (py_*).
 - buildfile_path is workspace-relative and prefixed with // (e.g. //pkg/sub/BUILD.bazel).
+- Bazel is always run in client/server mode. Do not add `startup --batch` to a bazelrc
+  used by this script: it restarts the server (and reloads every package) per query.
 """
 from __future__ import annotations
 
+import atexit
+import hashlib
 import json
 import os
+import re
+import shutil
 import subprocess
 import sys
-from collections import defaultdict
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, MutableMapping, Optional, Set, TypedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Generator, Iterator, List, Optional, Set, TextIO, Tuple, TypedDict
+
+try:
+    import orjson  # pyrefly: ignore[import-error]  # optional C JSON encoder, see dumps()
+except ImportError:
+    orjson = None
 
 # -------------------------
 # Logging
-# Uncomment to debug the bazel query
+# Set PYREFLY_DEBUG=1 to debug the bazel query; logs go to *.log in the cwd
 # -------------------------
+DEBUG = os.environ.get("PYREFLY_DEBUG") == "1"
+log_files: Dict[str, TextIO] = {}
+
+
 def log(message, file="app.log"):
-    # pass
+    if not DEBUG:
+        return
+    f = log_files.get(file)
+    if f is None:
+        # Opened once and kept for the life of the process; closed (and flushed) at exit
+        f = log_files[file] = open(file, "a")
+        atexit.register(f.close)
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(file, "a") as f:
-        f.write(f"{ts} - {message}\n")
+    f.write(f"{ts} - {message}\n")
 
 
 # -------------------------
 # Types
 # -------------------------
+class RuleAttrs(TypedDict):
+    kind: str
+    srcs: List[str]  # file labels
+    deps: List[str]  # all dep labels
+    buildfile: str  # absolute path of the declaring BUILD file, "" if unknown
+
+
 class TargetInfo(TypedDict):
     kind: str
     src_paths: List[str]
     deps_labels: List[str]  # only py_* deps
+    buildfile: str
 
 
 class DistributionEntry(TypedDict):
@@ -72,56 +108,421 @@ class BuildDbResult(TypedDict):
 # -------------------------
 # Bazel helpers
 # -------------------------
-def run(cmd: List[str], cwd: Optional[str] = None) -> str:
-    res = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    # Allow warnings (non-zero) if stdout still produced something useful
-    if res.returncode != 0 and not res.stdout.strip():
-        raise RuntimeError(f"Command failed: {' '.join(cmd)}\nstdout:\n{res.stdout}\nstderr:\n{res.stderr}")
+def run(cmd: List[str], cwd: Optional[str] = None) -> bytes:
+    """
+    Run `cmd` and return its stripped stdout as raw bytes; callers that need text
+    go through decode() once instead of paying for a text-mode pipe.
+    """
+    # --batch stops the server after every command and throws away its loaded package graph
+    assert "--batch" not in cmd, f"refusing to run bazel with --batch: {cmd}"
+    res = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = res.stdout.strip()
+    # Allow warnings (non-zero) if stdout still produced something useful. Exit code 3 is
+    # bazel's "--keep_going finished with errors" (and buildozer's "nothing changed"): the
+    # output is still complete for everything that could be evaluated, even when empty.
+    if res.returncode not in (0, 3) and not out:
+        raise RuntimeError(
+            f"Command failed: {' '.join(cmd)}\nstdout:\n{decode(res.stdout)}\nstderr:\n{decode(res.stderr)}"
+        )
     if res.stderr.strip():
-        log(f"bazel stderr for {' '.join(cmd)}:\n{res.stderr}", "bazel.log")
-    return res.stdout.strip()
+        log(f"bazel stderr for {' '.join(cmd)}:\n{decode(res.stderr)}", "bazel.log")
+    return out
+
+
+def run_stream(cmd: List[str], cwd: Optional[str] = None) -> Generator[str, None, int]:
+    """
+    Like run(), but yield the non-empty stdout lines as the command writes them, so
+    callers can parse while it is still running instead of buffering the whole output.
+    The generator returns the exit code (`code = yield from run_stream(...)`), so callers
+    can tell complete output from the partial output of a command that failed after writing.
+    """
+    assert "--batch" not in cmd, f"refusing to run bazel with --batch: {cmd}"
+    # stderr goes to a file: a PIPE nobody reads while stdout streams could fill up and block the child
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=err)
+        assert proc.stdout is not None
+        produced = finished = False
+        try:
+            with proc.stdout:
+                for raw in proc.stdout:
+                    line = raw.strip()
+                    if line:
+                        produced = True
+                        yield decode(line)
+            finished = True
+        finally:
+            if not finished:
+                # The consumer stopped early (or failed mid-parse); don't leave the child running
+                proc.kill()
+                proc.wait()
+        returncode = proc.wait()
+        err.seek(0)
+        stderr = err.read()
+    # Same policy as run(): see there for exit code 3
+    if returncode not in (0, 3) and not produced:
+        raise RuntimeError(f"Command failed: {' '.join(cmd)}\nstderr:\n{decode(stderr)}")
+    if stderr.strip():
+        log(f"bazel stderr for {' '.join(cmd)}:\n{decode(stderr)}", "bazel.log")
+    return returncode
+
+
+def decode(out: bytes) -> str:
+    return out.decode("utf-8", errors="replace")
+
+
+def bazel(*args: str) -> List[str]:
+    """
+    Build a bazel command line. If PYREFLY_BAZEL_OUTPUT_BASE is set it is passed as the
+    --output_base startup option, giving this script its own long-lived server that is not
+    restarted or blocked by the user's builds (at the cost of a second output base on disk).
+    """
+    output_base = os.environ.get("PYREFLY_BAZEL_OUTPUT_BASE")
+    if output_base:
+        return ["bazel", f"--output_base={os.path.expanduser(output_base)}", *args]
+    return ["bazel", *args]
 
 
 def bazel_info_workspace() -> str:
-    return run(["bazel", "info", "workspace"])
+    return decode(run(bazel("info", "workspace")))
+
+
+def warm_bazel_server() -> Optional["subprocess.Popen[bytes]"]:
+    """
+    Start the bazel server in the background so it is already up by the time a query
+    needs it. Returns the `bazel version` process, which the caller must wait() on.
+    Disable with PYREFLY_WARMUP=0.
+    """
+    if os.environ.get("PYREFLY_WARMUP", "1") != "1":
+        return None
+    try:
+        return subprocess.Popen(bazel("version"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        log(f"bazel warmup failed: {e}", "bazel.log")
+        return None
+
+
+def find_workspace(start: Optional[str] = None) -> str:
+    """
+    Walk up from `start` (default: cwd) to the first directory holding a workspace
+    boundary file, the same way the bazel client locates the workspace root.
+    Only falls back to `bazel info workspace` (a full client/server roundtrip) if none is found.
+    """
+    here = Path(os.path.realpath(start or os.getcwd()))
+    for directory in (here, *here.parents):
+        for marker in ("MODULE.bazel", "REPO.bazel", "WORKSPACE.bazel", "WORKSPACE"):
+            if (directory / marker).is_file():
+                return str(directory)
+    return bazel_info_workspace()
+
+
+# -------------------------
+# Query result cache
+# Set PYREFLY_BAZEL_CACHE=0 to disable
+# -------------------------
+def cache_enabled() -> bool:
+    return os.environ.get("PYREFLY_BAZEL_CACHE", "1") != "0"
+
+
+def cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pyrefly_bazel_query")
+
 
+def cache_path(key: str) -> str:
+    # Entries live under cache_dir()/<sha1[:2]>/<sha1>.json
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir(), digest[:2], f"{digest}.json")
 
-def bazel_query(query: str, output: Optional[str] = None) -> List[str]:
-    args = ["bazel", "query", query, "--keep_going", "--noshow_progress"]
+
+def cache_get(key: str, fingerprint: str) -> Optional[str]:
+    """
+    Return the value stored for `key`, or None. An entry holds one value per key,
+    tagged with the workspace fingerprint it was computed under; a different
+    fingerprint is a miss (and the next cache_put replaces the stale entry in place).
+    """
+    try:
+        with open(cache_path(key), "r") as f:
+            entry = json.load(f)
+        if entry.get("key") == key and entry.get("fingerprint") == fingerprint:
+            return entry["value"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def cache_put(key: str, fingerprint: str, value: str) -> None:
+    path = cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "fingerprint": fingerprint, "value": value}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log(f"failed to write query cache {path}: {e}", "bazel.log")
+
+
+def query_jobs() -> int:
+    # Worker cap for parallel filesystem scans; override with PYREFLY_BAZEL_JOBS
+    default = min(32, (os.cpu_count() or 1) * 4)
+    try:
+        return max(1, int(os.environ.get("PYREFLY_BAZEL_JOBS", default)))
+    except ValueError:
+        return default
+
+
+# Files whose contents can change query results: BUILD files, the repository/module
+# definitions and bazelrc at the root, plus any *.bzl macro or rule definition
+BUILD_INPUT_NAMES = frozenset({
+    "BUILD", "BUILD.bazel", "MODULE.bazel", "REPO.bazel", "WORKSPACE", "WORKSPACE.bazel", ".bazelrc",
+})
+
+
+def scan_build_dir(directory: str, workspace: str) -> Tuple[List[Tuple[str, int]], List[str]]:
+    # One directory level: stamps for build inputs and subdirectories, plus subdirectories to descend into
+    stamps: List[Tuple[str, int]] = []
+    subdirs: List[str] = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.startswith((".", "bazel-")):
+                        continue
+                    subdirs.append(entry.path)
+                elif entry.name not in BUILD_INPUT_NAMES and not entry.name.endswith(".bzl"):
+                    continue
+                rel = os.path.relpath(entry.path, workspace)
+                stamps.append((rel, entry.stat(follow_symlinks=False).st_mtime_ns))
+    except OSError:
+        pass
+    return stamps, subdirs
+
+
+def scan_build_tree(root: str, workspace: str) -> List[Tuple[str, int]]:
+    stamps: List[Tuple[str, int]] = []
+    pending = [root]
+    while pending:
+        found, subdirs = scan_build_dir(pending.pop(), workspace)
+        stamps.extend(found)
+        pending.extend(subdirs)
+    return stamps
+
+
+def buildfile_mtimes(workspace: str) -> List[Tuple[str, int]]:
+    """
+    (workspace-relative path, mtime_ns) for every build input (see BUILD_INPUT_NAMES, *.bzl)
+    and directory under the workspace.
+    Directory mtimes change when files are added or removed, so glob() results are covered too.
+    Dot-directories and bazel-* output trees are skipped; symlinks are not followed.
+    Top-level subtrees are scanned in parallel (scandir/stat release the GIL).
+    """
+    stamps: List[Tuple[str, int]] = [(".", os.stat(workspace).st_mtime_ns)]
+    found, subtrees = scan_build_dir(workspace, workspace)
+    stamps.extend(found)
+    if subtrees:
+        with ThreadPoolExecutor(max_workers=min(query_jobs(), len(subtrees))) as pool:
+            for sub in pool.map(lambda root: scan_build_tree(root, workspace), subtrees):
+                stamps.extend(sub)
+    return sorted(stamps)
+
+
+def workspace_fingerprint(workspace: str) -> str:
+    """
+    sha256 over the bazel version and buildfile_mtimes(); the stamp list can run to
+    megabytes on a large monorepo, so only its digest is stored with cache entries.
+    Not memoized: the tool can run several times in one process (main_with_files is
+    an in-process entry point), and each run must see the tree as it is now.
+    build_db_for_files issues a single query, so this is computed once per call.
+    """
+    # The version probe waits on a subprocess; let it run while the filesystem is scanned
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        version = pool.submit(run, ["bazel", "--version"])
+        mtimes = buildfile_mtimes(workspace)
+        stamp = json.dumps([decode(version.result()), mtimes])
+    return hashlib.sha256(stamp.encode("utf-8")).hexdigest()
+
+
+# Longer expressions are passed via --query_file to stay clear of argv limits
+# (32 KiB command lines on Windows, 128 KiB per argument on Linux)
+QUERY_FILE_THRESHOLD = 8192
+
+
+def bazel_query_file(expr: str, flags: List[str], cwd: Optional[str] = None) -> Generator[str, None, int]:
+    """
+    Stream `bazel query --query_file=<tmp>` with `expr` written to a temporary .bzlq file.
+    Returns the exit code like run_stream().
+    """
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".bzlq") as f:
+        f.write(expr)
+        query_file = f.name
+    try:
+        return (yield from run_stream(bazel("query", f"--query_file={query_file}", *flags), cwd=cwd))
+    finally:
+        os.unlink(query_file)
+
+
+def bazel_query_lines(
+    query: str, output: Optional[str] = None, workspace: Optional[str] = None
+) -> Generator[str, None, None]:
+    """
+    Run `bazel query` and yield its non-empty output lines as bazel writes them.
+    When `workspace` is given, bazel runs from the workspace root (so relative file
+    paths in the expression resolve against it) and results are cached on disk until
+    a BUILD file, a directory listing or the bazel version changes.
+    """
+    # --noimplicit_deps keeps deps() on explicit edges; otherwise every py_binary drags in
+    # @bazel_tools, the launcher and toolchain packages (fetching those repos on a cold server)
+    flags = ["--keep_going", "--noshow_progress", "--noimplicit_deps"]
     if output:
-        args.extend(["--output", output])
-    out = run(args)
-    return [ln.strip() for ln in out.splitlines() if ln.strip()]
+        flags.extend(["--output", output])
+    args = bazel("query", query, *flags)
+
+    lines: Generator[str, None, int]
+    if len(query) > QUERY_FILE_THRESHOLD:
+        lines = bazel_query_file(query, flags, cwd=workspace)
+    else:
+        lines = run_stream(args, cwd=workspace)
+    if workspace is None or not cache_enabled():
+        yield from lines
+        return
+
+    # The entry's file is picked by (args, workspace) alone, so a new fingerprint overwrites
+    # the stale entry instead of leaving it orphaned under another name
+    key = json.dumps([args, workspace])
+    # Without any entry this is a certain miss: start the server now so it boots while the
+    # workspace is fingerprinted. Runs answered from the cache never start bazel.
+    warmup = None if os.path.exists(cache_path(key)) else warm_bazel_server()
+    try:
+        fingerprint = workspace_fingerprint(workspace)
+        cached = cache_get(key, fingerprint)
+        if cached is not None:
+            lines.close()  # never started, so no bazel process is spawned
+            yield from cached.splitlines()
+            return
+        seen: List[str] = []
+        returncode = None
+        while returncode is None:
+            try:
+                line = next(lines)
+            except StopIteration as done:
+                returncode = done.value
+                continue
+            seen.append(line)
+            yield line
+        # Only complete results are stored: output of a query that failed part-way, or finished
+        # with --keep_going errors (exit 3), would otherwise be replayed until a BUILD file changes
+        if returncode == 0:
+            cache_put(key, fingerprint, "\n".join(seen))
+    finally:
+        if warmup is not None:
+            warmup.wait()
+
+
+def bazel_query(query: str, output: Optional[str] = None, workspace: Optional[str] = None) -> List[str]:
+    """Run `bazel query` and return its non-empty output lines (see bazel_query_lines)."""
+    return list(bazel_query_lines(query, output=output, workspace=workspace))
+
+
+def bazel_query_proto(query: str, workspace: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Run a query with --output=streamed_jsonproto and return the decoded rule dicts.
+    Each rule dict carries "name", "ruleClass" and an "attribute" list.
+    """
+    rules: List[Dict[str, Any]] = []
+    # Rules are decoded as bazel streams them rather than after the whole output is buffered
+    for line in bazel_query_lines(query, output="streamed_jsonproto", workspace=workspace):
+        target = json.loads(line)
+        if target.get("type") == "RULE":
+            rules.append(target["rule"])
+    return rules
 
 
-def label_kind(label: str) -> str:
-    # "py_library rule //path:target" -> "py_library"
-    lines = bazel_query(label, output="label_kind")
-    log(lines, "bazel.log")
-    if not lines:
-        return ""
-    return lines[0].split()[0]
+def buildfile_from_location(location: str) -> str:
+    # Rules carry the place they were declared: /abs/workspace/pkg/BUILD.bazel:3:11
+    return location.rsplit(":", 2)[0] if location else ""
+
+
+def rule_attr_labels(rule: Dict[str, Any], name: str) -> List[str]:
+    # Label-list attributes carry their values in "stringListValue" (omitted when empty)
+    for attr in rule.get("attribute", []):
+        if attr.get("name") == name:
+            return list(attr.get("stringListValue", []))
+    return []
+
+
+# Rule kinds treated as python targets. Bazel's kind() does an unanchored regex search on
+# "<rule class> rule"; PY_KIND_RE applies the same test locally to kinds read without bazel.
+PY_KIND_PATTERN = "py_.* rule"
+PY_KIND_RE = re.compile(PY_KIND_PATTERN)
+
+
+def is_py_kind(kind: str) -> bool:
+    return PY_KIND_RE.search(f"{kind} rule") is not None
+
+
+def add_py_rules(targets: Dict[str, RuleAttrs], query: str, workspace: Optional[str]) -> None:
+    for rule in bazel_query_proto(query, workspace=workspace):
+        targets[rule["name"]] = {
+            "kind": rule.get("ruleClass", ""),
+            "srcs": rule_attr_labels(rule, "srcs"),
+            "deps": rule_attr_labels(rule, "deps"),
+            "buildfile": buildfile_from_location(rule.get("location", "")),
+        }
+
+
+# Characters that cannot appear inside a double-quoted query word
+UNQUOTABLE_RE = re.compile(r'["\\\x00-\x1f\x7f]')
+
+
+def is_queryable_path(path: str) -> bool:
+    return UNQUOTABLE_RE.search(path) is None
 
 
+def py_targets_query(paths: List[str]) -> str:
+    """
+    Query for the python targets owning any of `paths` (workspace-relative source files)
+    together with their transitive python deps, external repositories included.
+    same_pkg_direct_rdeps() maps each file to its owning rules by loading only the file's
+    package, instead of loading //... to build a reverse index over the whole workspace.
+    The catch is that only rules declared in the file's own package are found: a rule in
+    //other that lists //pkg:file.py in its srcs does not own the file here.
+    Every path must pass is_queryable_path().
+    """
+    files = " ".join(f'"{p}"' for p in sorted(set(paths)))
+    owners = f"kind('{PY_KIND_PATTERN}', same_pkg_direct_rdeps(set({files})))"
+    return f"kind('{PY_KIND_PATTERN}', deps({owners}))"
+
+
+def bazel_py_targets(paths: List[str], workspace: Optional[str] = None) -> Dict[str, RuleAttrs]:
+    """
+    Kind, srcs and deps of the python targets owning `paths` and everything they
+    depend on, from one bazel query.
+    """
+    targets: Dict[str, RuleAttrs] = {}
+    if paths:
+        add_py_rules(targets, py_targets_query(paths), workspace)
+    return targets
+
+
+@lru_cache(maxsize=None)
 def file_label_to_path(file_label: str) -> str:
-    # //pkg:filename.py -> pkg/filename.py
+    # //pkg:filename.py -> pkg/filename.py ; //:filename.py (root package) -> filename.py
     if not file_label.startswith("//"):
         return file_label
     pkg_and_file = file_label[2:]
     if ":" in pkg_and_file:
         pkg, fname = pkg_and_file.split(":", 1)
-        return f"{pkg}/{fname}"
+        return f"{pkg}/{fname}" if pkg else fname
     return pkg_and_file
 
 
+@lru_cache(maxsize=None)
 def module_name_from_path(path: str) -> str:
     # path/to/__init__.py -> path.to ; path/to/file.py -> path.to.file
+    # str.replace of a single character is a memchr-driven C loop, much faster than translate()
     if not path.endswith(".py"):
         return path.replace("/", ".")
-    mod = path[:-3].replace("/", ".")
-    if mod.endswith(".__init__"):
-        mod = mod[: -len(".__init__")]
-    return mod
+    return path[:-3].replace("/", ".").removesuffix(".__init__")
 
 
 def system_python_platform() -> str:
@@ -135,155 +536,225 @@ def system_python_platform() -> str:
     return p
 
 
-label_kind_cache: Dict[str, str] = {}
+# Runtime constants shared by every emitted entry
+PYTHON_VERSION = f"{sys.version_info.major}.{sys.version_info.minor}"
+PYTHON_PLATFORM = system_python_platform()
 
 
-def cached_label_kind(label: str) -> str:
-    k = label_kind_cache.get(label)
-    if k is not None:
-        return k
-    k = label_kind(label)
-    label_kind_cache[label] = k
-    return k
-
-
-def buildfile_for_label(label: str, workspace: str) -> str:
+def buildfile_for_label(label: str, workspace: str, probed: Dict[str, str]) -> str:
     """
     //pkg/sub:target -> /abs/workspace/pkg/sub/BUILD.bazel | BUILD (absolute path)
+    `probed` memoizes results per package for the duration of one build_db_for_files call,
+    so targets of the same package share a lookup without going stale across calls.
     """
     if not label.startswith("//"):
         return ""
     pkg = label[2:].split(":", 1)[0]
-    cands = [os.path.join(workspace, pkg, "BUILD.bazel"), os.path.join(workspace, pkg, "BUILD")]
-    for cand in cands:
+    if pkg not in probed:
+        probed[pkg] = package_buildfile(pkg, workspace)
+    return probed[pkg]
+
+
+def package_buildfile(pkg: str, workspace: str) -> str:
+    for name in ("BUILD.bazel", "BUILD"):
+        cand = os.path.join(workspace, pkg, name)
         if os.path.exists(cand):
             return cand
     return ""
 
 
-def relativize_buildfile_path(abs_buildfile: str, workspace: str) -> str:
+def relativize_buildfile_path(abs_buildfile: str, workspace_prefix: str) -> str:
     """
     Convert an absolute buildfile path under the workspace to //-prefixed workspace-relative form.
     /abs/workspace/pkg/sub/BUILD.bazel -> //pkg/sub/BUILD.bazel
-    If not under workspace, return as-is.
+    `workspace_prefix` is the normalized workspace path plus a trailing separator, computed once
+    by the caller. If not under workspace, return as-is.
     """
-    if not abs_buildfile:
-        return ""
-    # Normalize to avoid subtle path issues
-    workspace = os.path.normpath(workspace)
-    abs_buildfile = os.path.normpath(abs_buildfile)
-    if abs_buildfile.startswith(workspace + os.sep):
-        rel = os.path.relpath(abs_buildfile, workspace)
-        # Always use forward slashes in Bazel-style paths
+    if not abs_buildfile.startswith(workspace_prefix):
+        return abs_buildfile
+    rel = abs_buildfile[len(workspace_prefix):]
+    # Always use forward slashes in Bazel-style paths
+    if os.sep != "/":
         rel = rel.replace(os.sep, "/")
-        return f"//{rel}"
-    return abs_buildfile
+    return f"//{rel}"
 
 
 # -------------------------
-# Collect per-target info
+# Buildozer helpers
 # -------------------------
-def collect_py_target_info(target_label: str, cache: MutableMapping[str, TargetInfo]) -> TargetInfo:
-    log([target_label], "bazel.log")
-    if target_label in cache:
-        return cache[target_label]
-
-    kind = cached_label_kind(target_label)
-    file_labels = bazel_query(f"labels('srcs', {target_label})")
-    src_paths = [file_label_to_path(fl) for fl in file_labels]
-
-    dep_labels_all = bazel_query(f"labels('deps', {target_label})")
-    py_dep_labels: List[str] = []
-    for dl in dep_labels_all:
-        k = cached_label_kind(dl)
-        if k.startswith("py_"):
-            py_dep_labels.append(dl)
-
-    info: TargetInfo = {
-        "kind": kind,
-        "src_paths": src_paths,
-        "deps_labels": py_dep_labels,
-    }
-    cache[target_label] = info
-    return info
+def absolute_label(value: str, pkg: str) -> str:
+    # ":dep" / "file.py" -> "//pkg:dep" ; "//pkg" -> "//pkg:pkg" ; external labels as-is
+    if value.startswith("@"):
+        return value
+    if value.startswith("//"):
+        if ":" in value:
+            return value
+        return f"{value}:{value.rsplit('/', 1)[-1]}"
+    return f"//{pkg}:{value.lstrip(':')}"
+
+
+def split_buildozer_fields(line: str) -> List[str]:
+    # Split on whitespace outside of [...] and (...) so lists and expressions stay whole
+    fields: List[str] = []
+    current: List[str] = []
+    depth = 0
+    for ch in line:
+        if ch.isspace() and depth == 0:
+            if current:
+                fields.append("".join(current))
+                current = []
+            continue
+        if ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        current.append(ch)
+    if current:
+        fields.append("".join(current))
+    return fields
+
+
+def parse_buildozer_output(out: str) -> Dict[str, RuleAttrs]:
+    """
+    Parse `buildozer 'print label kind srcs deps'` lines such as
+      //pkg:name py_library [a.py b.py] [:dep //other:dep]
+    Missing attributes print as "(missing)". Values that are not literal lists
+    (glob(), select(), ...) cannot be evaluated by buildozer and are dropped.
+    """
+    targets: Dict[str, RuleAttrs] = {}
+    for line in out.splitlines():
+        fields = split_buildozer_fields(line.strip())
+        if len(fields) < 2 or not fields[0].startswith("//"):
+            continue
+        label, kind = fields[0], fields[1]
+        pkg = label[2:].split(":", 1)[0]
+        lists: List[List[str]] = []
+        for field in (fields[2:] + ["(missing)", "(missing)"])[:2]:
+            if field.startswith("[") and field.endswith("]"):
+                lists.append([absolute_label(v, pkg) for v in field[1:-1].split()])
+            else:
+                if field != "(missing)":
+                    log(f"buildozer: cannot evaluate {field} on {label}", "bazel.log")
+                lists.append([])
+        targets[label] = {"kind": kind, "srcs": lists[0], "deps": lists[1], "buildfile": ""}
+    return targets
+
+
+def buildozer_dump(pattern: str = "//...:*", cwd: Optional[str] = None) -> Dict[str, RuleAttrs]:
+    """
+    Read kind, srcs and deps of every rule matching `pattern` straight from the BUILD files.
+    Buildozer skips Bazel's loading phase entirely, but it also does not expand macros or globs.
+    """
+    # buildozer exits with 3 when nothing was edited, which is always the case for print
+    return parse_buildozer_output(decode(run(["buildozer", "print label kind srcs deps", pattern], cwd=cwd)))
 
 
 # -------------------------
 # Build database (labels as keys)
 # -------------------------
-def build_db_for_files(file_paths: List[str]) -> BuildDbResult:
-    workspace = bazel_info_workspace()
-
-    # 1) enumerate all python targets
-    all_py_targets = bazel_query("kind('py_.* rule', //...)")
-
-    # 2) map "file path -> owning targets"
-    file_to_targets: Dict[str, List[str]] = {}
-    for tgt in all_py_targets:
-        file_labels = bazel_query(f"labels('srcs', {tgt})")
-        for fl in file_labels:
-            path = file_label_to_path(fl)
-            file_to_targets.setdefault(path, []).append(tgt)
-
-    # 3) determine owning targets for requested files
-    requested_targets: Set[str] = set()
+def build_db_for_files(file_paths: List[str], use_buildozer: bool = False) -> BuildDbResult:
+    workspace = find_workspace()
+
+    workspace_prefix = os.path.normpath(workspace) + os.sep
+
+    # 1) requested files as workspace-relative paths. Relative paths are relative to the cwd,
+    # which is read once (os.path.abspath would call getcwd per file); when it is the workspace
+    # root (the usual case) they are already workspace-relative.
+    # Files outside the workspace cannot be owned by any target and are dropped.
+    requested_paths: Set[str] = set()
+    cwd = os.getcwd()
+    cwd_is_workspace = cwd == workspace
     for fp in file_paths:
-        abs_fp = os.path.abspath(fp)
-        rel = os.path.relpath(abs_fp, workspace) if abs_fp.startswith(workspace) else fp
-        owners = file_to_targets.get(rel, [])
-        if not owners:
-            # fall back: suffix match
-            for key, tgts in file_to_targets.items():
-                if key.endswith(rel):
-                    owners.extend(tgts)
-        for o in owners:
-            requested_targets.add(o)
-
-    # 4) DFS through py deps
-    info_cache: MutableMapping[str, TargetInfo] = {}
+        if cwd_is_workspace and not os.path.isabs(fp):
+            rel = os.path.normpath(fp)
+            if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+                continue
+        else:
+            abs_fp = os.path.normpath(os.path.join(cwd, fp))
+            if not abs_fp.startswith(workspace_prefix):
+                continue
+            rel = abs_fp[len(workspace_prefix):]
+        # A path that cannot be quoted would break the whole query, which --keep_going does not cover
+        if not is_queryable_path(rel):
+            log(f"skipping {fp!r}: cannot be named in a bazel query", "bazel.log")
+            continue
+        requested_paths.add(rel)
+
+    # 2) kind, srcs and deps of the owning targets and their python deps in one invocation
+    if use_buildozer and shutil.which("buildozer"):
+        py_targets = {
+            label: attrs
+            for label, attrs in buildozer_dump(cwd=workspace).items()
+            if is_py_kind(attrs["kind"])
+        }
+    else:
+        if use_buildozer:
+            log("buildozer not found on PATH; falling back to bazel query", "bazel.log")
+        py_targets = bazel_py_targets(sorted(requested_paths), workspace)
+
+    # 3) pre-fill the target info cache and pick out the targets owning a requested file
+    info_cache: Dict[str, TargetInfo] = {}
+    requested_targets: Set[str] = set()
+    for tgt, attrs in py_targets.items():
+        src_paths = [file_label_to_path(fl) for fl in attrs["srcs"]]
+        info_cache[tgt] = {
+            "kind": attrs["kind"],
+            "src_paths": src_paths,
+            "deps_labels": [d for d in attrs["deps"] if d in py_targets],
+            "buildfile": attrs["buildfile"],
+        }
+        if not requested_paths.isdisjoint(src_paths):
+            requested_targets.add(tgt)
+
+    # 4) DFS through py deps: a pure walk over info_cache, no bazel calls per edge
     seen: Set[str] = set()
     topo: List[str] = []
 
-    def dfs(label: str) -> None:
-        if label in seen:
-            return
-        seen.add(label)
-        info = collect_py_target_info(label, info_cache)
-        for d in info["deps_labels"]:
-            dfs(d)
-        topo.append(label)
-
-    for t in sorted(requested_targets):
-        dfs(t)
+    # Iterative post-order with an explicit stack, so deep dep chains cannot hit the recursion limit
+    for root in sorted(requested_targets):
+        if root in seen:
+            continue
+        seen.add(root)
+        stack: List[Tuple[str, Iterator[str]]] = [(root, iter(info_cache[root]["deps_labels"]))]
+        while stack:
+            label, deps = stack[-1]
+            for d in deps:
+                if d not in seen:
+                    seen.add(d)
+                    stack.append((d, iter(info_cache[d]["deps_labels"])))
+                    break
+            else:
+                stack.pop()
+                topo.append(label)
 
     # 5) Build result database with LABEL KEYS and LABEL DEPS
     result_db: Dict[str, DistributionEntry] = {}
-    py_ver = f"{sys.version_info.major}.{sys.version_info.minor}"
-    py_plat = system_python_platform()
+    probed_buildfiles: Dict[str, str] = {}
+    # srcs/deps are collected in insertion-ordered dicts for O(1) dedup, then frozen to lists below
+    srcs_by_label: Dict[str, Dict[str, Dict[str, None]]] = {}
+    deps_by_label: Dict[str, Dict[str, None]] = {}
 
     def add_entry(label_key: str, srcs_map: Dict[str, List[str]], dep_labels: List[str], abs_buildfile_path: str) -> None:
-        buildfile_path = relativize_buildfile_path(abs_buildfile_path, workspace)
+        buildfile_path = relativize_buildfile_path(abs_buildfile_path, workspace_prefix)
         if label_key not in result_db:
             result_db[label_key] = {
                 "srcs": {},
                 "deps": [],
-                "python_version": py_ver,
-                "python_platform": py_plat,
+                "python_version": PYTHON_VERSION,
+                "python_platform": PYTHON_PLATFORM,
                 "buildfile_path": buildfile_path,
             }
+            srcs_by_label[label_key] = {}
+            deps_by_label[label_key] = {}
         ent = result_db[label_key]
         # If the entry already existed (multiple passes), ensure buildfile_path is set to the //-form
         if not ent.get("buildfile_path"):
             ent["buildfile_path"] = buildfile_path
 
+        mods = srcs_by_label[label_key]
         for mod, paths in srcs_map.items():
-            ent["srcs"].setdefault(mod, [])
-            for p in paths:
-                if p not in ent["srcs"][mod]:
-                    ent["srcs"][mod].append(p)
-        for d in dep_labels:
-            if d not in ent["deps"]:
-                ent["deps"].append(d)
+            mods.setdefault(mod, {}).update(dict.fromkeys(paths))
+        deps_by_label[label_key].update(dict.fromkeys(dep_labels))
 
     for label in topo:
         info = info_cache[label]
@@ -300,9 +771,18 @@ def build_db_for_files(file_paths: List[str]) -> BuildDbResult:
                 mod = module_name_from_path(p)
                 module_map.setdefault(mod, []).append(p)
 
-        abs_buildfile_path = buildfile_for_label(label, workspace)
+        # The query reports where each rule is declared; BUILD files are only probed for rules
+        # read without bazel (buildozer). External repositories have no workspace buildfile.
+        if label.startswith("//"):
+            abs_buildfile_path = info["buildfile"] or buildfile_for_label(label, workspace, probed_buildfiles)
+        else:
+            abs_buildfile_path = ""
         add_entry(label, module_map, info["deps_labels"], abs_buildfile_path)
 
+    for label_key, ent in result_db.items():
+        ent["srcs"] = {mod: list(paths) for mod, paths in srcs_by_label[label_key].items()}
+        ent["deps"] = list(deps_by_label[label_key])
+
     return {"db": result_db, "root": workspace}
 
 
@@ -314,33 +794,80 @@ def parse_file_list(file_path: str) -> List[str]:
     files: List[str] = []
     try:
         with open(file_path, "r") as f:
-            lines = [line.strip() for line in f if line.strip()]
-        for i, line in enumerate(lines):
-            if line == "--file" and i + 1 < len(lines):
-                files.append(lines[i + 1])
+            # One pass over the stripped non-blank lines; the value after "--file" is consumed directly
+            lines = (stripped for stripped in (line.strip() for line in f) if stripped)
+            for line in lines:
+                if line == "--file":
+                    value = next(lines, None)
+                    if value is not None:
+                        files.append(value)
     except Exception as e:
         print(json.dumps({"error": f"Failed to read file list: {e}"}), flush=True)
         sys.exit(2)
     return files
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
+def dumps(obj: Any, pretty: bool = False) -> str:
+    """
+    JSON-encode `obj`: indented by two spaces if `pretty`, otherwise without any
+    whitespace. Uses orjson when it is installed, stdlib json otherwise; non-ASCII
+    text is written as-is by both (orjson cannot escape it), so their output matches.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode("utf-8")
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def write_result(out: BuildDbResult, stream: TextIO, pretty: bool = False) -> None:
+    """
+    Write the result as JSON followed by a newline. The compact form is emitted one
+    distribution at a time, so the whole document never exists as a single string.
+    """
+    if pretty:
+        stream.write(dumps(out, pretty=True))
+    else:
+        stream.write('{"db":{')
+        for i, (label, entry) in enumerate(out["db"].items()):
+            if i:
+                stream.write(",")
+            stream.write(f"{dumps(label)}:{dumps(entry)}")
+        stream.write(f'}},"root":{dumps(out["root"])}}}')
+    stream.write("\n")
+    stream.flush()
+
+
+def main_with_files(files: List[str], use_buildozer: bool = False, pretty: bool = False) -> int:
+    if not files:
+        print(json.dumps({"error": "No files found in list"}), flush=True)
+        return 2
+
+    out = build_db_for_files(files, use_buildozer=use_buildozer)
+    if DEBUG:
+        log(dumps(out, pretty=True), "dumps.log")
+    write_result(out, sys.stdout, pretty=pretty)
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    use_buildozer = "--use_buildozer" in argv
+    pretty = "--pretty" in argv
+    argv = [a for a in argv if a not in ("--use_buildozer", "--pretty")]
+    if not argv:
         print(json.dumps({"error": "Usage: script.py @/path/to/list.txt"}), flush=True)
-        sys.exit(2)
+        return 2
 
-    arg = sys.argv[1]
+    arg = argv[0]
     if not arg.startswith("@"):
         print(json.dumps({"error": "Expected an argument starting with @"}), flush=True)
-        sys.exit(2)
+        return 2
 
     file_list_path = arg[1:]
     files = parse_file_list(file_list_path)
+    return main_with_files(files, use_buildozer=use_buildozer, pretty=pretty)
 
-    if not files:
-        print(json.dumps({"error": "No files found in list"}), flush=True)
-        sys.exit(2)
 
-    out = build_db_for_files(files)
-    log(json.dumps(out, indent=2), "dumps.log")
-    print(json.dumps(out, indent=2), flush=True)
+if __name__ == "__main__":
+    sys.exit(main())